@@ -0,0 +1,80 @@
+import subprocess
+import ffmpeg
+
+# Characters with special meaning to the filter option parser and to the graph parser
+OPTION_SPECIAL = "'=:"
+GRAPH_SPECIAL = "'[],;"
+
+def escape(value, chars: str) -> str:
+    """Backslash-escapes chars in value (backslash itself first)."""
+    text = str(value).replace('\\', '\\\\')
+    for ch in chars:
+        text = text.replace(ch, '\\' + ch)
+    return text
+
+def filter_spec(name: str, *args, **kwargs) -> str:
+    """
+    Formats a single filter, e.g. filter_spec('scale', 1920, 1080) -> 'scale=1920:1080'.
+    Values are escaped for the option parser, then the whole spec for the graph parser.
+    """
+    params = [escape(a, OPTION_SPECIAL) for a in args]
+    params += [f"{k}={escape(v, OPTION_SPECIAL)}" for k, v in kwargs.items()]
+    spec = name if not params else f"{name}={':'.join(params)}"
+    return escape(spec, GRAPH_SPECIAL)
+
+class FilterGraph:
+    """
+    Minimal -filter_complex builder with explicit stream labels.
+    Every input and chain is its own node, so identical clips are never merged
+    the way ffmpeg-python merges nodes with equal hashes.
+    Streams are passed around as bracketed labels: '[0:v]' for inputs, '[s3]' for chain outputs.
+    """
+
+    def __init__(self):
+        self.input_args: list[str] = []
+        self.chains: list[str] = []
+        self.output_args: list[str] = []
+        self._inputs = 0
+        self._labels = 0
+
+    def input(self, path: str, **options) -> int:
+        """Adds an input file, returns its index."""
+        for key, value in options.items():
+            self.input_args += [f'-{key}', str(value)]
+        self.input_args += ['-i', path]
+        self._inputs += 1
+        return self._inputs - 1
+
+    def chain(self, inputs: list[str], filters: list[str], outputs: int = 1):
+        """Adds a filter chain fed by inputs, returns its output label (or labels if outputs > 1)."""
+        labels = []
+        for _ in range(outputs):
+            labels.append(f'[s{self._labels}]')
+            self._labels += 1
+        self.chains.append(''.join(inputs) + ','.join(filters) + ''.join(labels))
+        return labels[0] if outputs == 1 else labels
+
+    def output(self, streams: list[str], path: str, **options):
+        """Adds an output file encoding the given streams."""
+        for stream in streams:
+            # Chain outputs are mapped by label, input streams by bare specifier
+            self.output_args += ['-map', stream if stream.startswith('[s') else stream[1:-1]]
+        for key, value in options.items():
+            self.output_args += [f'-{key}', str(value)]
+        self.output_args.append(path)
+
+    def script(self) -> str:
+        return ';'.join(self.chains)
+
+    def command(self) -> list[str]:
+        args = ['ffmpeg', '-y', *self.input_args]
+        if self.chains:
+            args += ['-filter_complex', self.script()]
+        return args + self.output_args
+
+    def run(self):
+        """Runs ffmpeg, raising ffmpeg.Error like ffmpeg-python's run() on failure."""
+        cmd = self.command()
+        result = subprocess.run(cmd)
+        if result.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', None, None)
@@ -1,15 +1,23 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.formparsers import MultiPartParser
+import aiofiles
+import io
 import os
-import shutil
+import tempfile
 import uuid
 import traceback
 import ffmpeg
-from models import Project
-from renderer import render_project
+from celery.result import AsyncResult
+from models import Project, RenderResponse, UploadResponse
+from renderer import render_project, AUDIO_STREAM_CACHE, VIDEO_STREAM_CACHE, audio_info_from_probe, video_info_from_probe
+from tasks import celery_app, render_task
 
-app = FastAPI()
+# orjson encodes responses several times faster than the stdlib json encoder
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -27,22 +35,62 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(PREVIEW_DIR, exist_ok=True)
 
 # Static mounts
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
-app.mount("/previews", StaticFiles(directory=PREVIEW_DIR), name="previews")
+# In production (PROD=1) nginx serves media/ with sendfile, see README.md
+PROD = os.getenv("PROD", "0").lower() not in ("0", "false", "no", "off", "")
+if not PROD:
+    app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+    app.mount("/previews", StaticFiles(directory=PREVIEW_DIR), name="previews")
 
 @app.get("/")
 def read_root():
     return {"status": "ok", "message": "Video Editor Backend Running"}
 
-@app.post("/upload")
+def disk_fileno(file: UploadFile):
+    """File descriptor of an upload that is backed by a real file, None while still in memory."""
+    # fileno() on a SpooledTemporaryFile forces a rollover to disk, so in-memory uploads must be
+    # ruled out first. Starlette spools to disk once a part grows past spool_max_size.
+    if isinstance(file.file, tempfile.SpooledTemporaryFile):
+        if file.size is None or file.size <= MultiPartParser.spool_max_size:
+            return None
+    try:
+        return file.file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+def sendfile_copy(in_fd: int, file_path: str):
+    """Copies in_fd to file_path inside the kernel (no userspace buffers)."""
+    size = os.fstat(in_fd).st_size
+    with open(file_path, "wb") as out:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out.fileno(), in_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+async def save_upload(file: UploadFile, file_path: str):
+    """Writes an upload to disk without blocking the event loop."""
+    in_fd = disk_fileno(file)
+    if in_fd is not None:
+        try:
+            await run_in_threadpool(sendfile_copy, in_fd, file_path)
+            return
+        except OSError:
+            # sendfile to a regular file is Linux-only, fall back to chunked copy
+            await file.seek(0)
+    
+    async with aiofiles.open(file_path, "wb") as out:
+        while chunk := await file.read(1 << 20):
+            await out.write(chunk)
+
+@app.post("/upload", response_model=UploadResponse)
 async def upload_file(file: UploadFile = File(...)):
     file_id = str(uuid.uuid4())
     extension = os.path.splitext(file.filename)[1].lower()
     filename = f"{file_id}{extension}"
     file_path = os.path.join(UPLOAD_DIR, filename)
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await save_upload(file, file_path)
     
     # For WebM audio files (browser recordings), re-encode to fix duration metadata
     # Chrome has a bug where WebM duration is not written correctly
@@ -66,10 +114,21 @@ async def upload_file(file: UploadFile = File(...)):
         except Exception as e:
             print(f"Warning: Could not fix WebM duration for {filename}: {e}")
         
-    # Get Duration using ffprobe
+    # Get Duration and streams using a single ffprobe
     duration = 10.0 # Default fallback
+    has_video = False
+    width = height = None
     try:
         probe = ffmpeg.probe(file_path)
+        video_info = video_info_from_probe(probe)
+        has_video = video_info is not None
+        if video_info:
+            # Displayed size, i.e. after rotation side data is applied
+            width = video_info['width']
+            height = video_info['height']
+        # Renders look these up instead of spawning ffprobe per clip
+        AUDIO_STREAM_CACHE[file_path] = audio_info_from_probe(probe)
+        VIDEO_STREAM_CACHE[file_path] = video_info
         # format.duration is usually the container duration
         duration = float(probe['format']['duration'])
     except Exception as e:
@@ -80,20 +139,39 @@ async def upload_file(file: UploadFile = File(...)):
         "id": file_id,
         "filename": filename,
         "url": f"/uploads/{filename}",
-        "type": "video" if extension in ['.mp4', '.mov', '.avi', '.mkv', '.webm'] and has_video_stream(file_path) else "audio",
-        "duration": duration
+        "type": "video" if extension in ['.mp4', '.mov', '.avi', '.mkv', '.webm'] and has_video else "audio",
+        "duration": duration,
+        "width": width,
+        "height": height
     }
 
-def has_video_stream(file_path):
-    """Check if file has a video stream"""
-    try:
-        probe = ffmpeg.probe(file_path)
-        return any(stream['codec_type'] == 'video' for stream in probe['streams'])
-    except:
-        return False
+def render_status(task_id: str):
+    """Maps a render task's state to the response shape used by /preview and /export."""
+    result = AsyncResult(task_id, app=celery_app)
+    
+    if result.state in ("PENDING", "RECEIVED", "STARTED", "RETRY"):
+        return {"task_id": task_id, "status": "processing"}
+    
+    if result.state == "SUCCESS":
+        output_paths = result.result["outputs"]
+        if not output_paths:
+            return {"task_id": task_id, "status": "error"}
+        urls = [f"/previews/{os.path.basename(p)}?t={str(uuid.uuid4())}" for p in output_paths]
+        response = {
+            "task_id": task_id,
+            "url": urls[0],
+            "status": "ready",
+            "codec": result.result["codec"]
+        }
+        # /export?include_preview=true also refreshes the preview in the same render
+        if len(urls) > 1:
+            response["preview_url"] = urls[1]
+        return response
+    
+    return {"task_id": task_id, "status": "error", "detail": str(result.result)}
 
-@app.post("/preview")
-async def generate_preview(project: Project):
+@app.post("/preview", response_model=RenderResponse, response_model_exclude_none=True)
+def generate_preview(project: Project):
     try:
         preview_filename = f"preview_{project.id}.mp4"
         preview_path = os.path.join(PREVIEW_DIR, preview_filename)
@@ -102,32 +180,40 @@ async def generate_preview(project: Project):
         if not has_clips:
              return {"url": "", "status": "empty"}
 
-        result = render_project(project, preview_path, preset='ultrafast', crf=28)
-        if not result:
-            return {"url": "", "status": "error"}
-        
-        return {"url": f"/previews/{preview_filename}?t={str(uuid.uuid4())}", "status": "ready"}
+        task = render_task.delay(project.model_dump(), [(preview_path, 'ultrafast', 28)])
+        return {"task_id": task.id, "status": "processing"}
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/export")
-async def export_video(project: Project):
+@app.get("/preview/{task_id}", response_model=RenderResponse, response_model_exclude_none=True)
+def preview_status(task_id: str):
+    return render_status(task_id)
+
+@app.post("/export", response_model=RenderResponse, response_model_exclude_none=True)
+def export_video(project: Project, include_preview: bool = False):
     try:
         export_filename = f"export_{project.id}.mp4"
         export_path = os.path.join(PREVIEW_DIR, export_filename)
         
-        result = render_project(project, export_path, preset='medium', crf=23)
-        if not result:
-            raise HTTPException(status_code=500, detail="Render failed")
-            
-        return {"url": f"/previews/{export_filename}", "status": "ready"}
+        outputs = [(export_path, 'medium', 23)]
+        if include_preview:
+            # Decode and filter once, encode both the export and the preview
+            preview_path = os.path.join(PREVIEW_DIR, f"preview_{project.id}.mp4")
+            outputs.append((preview_path, 'ultrafast', 28))
+        
+        task = render_task.delay(project.model_dump(), outputs)
+        return {"task_id": task.id, "status": "processing"}
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/merge")
-async def merge_clips(project: Project):
+@app.get("/export/{task_id}", response_model=RenderResponse, response_model_exclude_none=True)
+def export_status(task_id: str):
+    return render_status(task_id)
+
+@app.post("/merge", response_model=UploadResponse)
+def merge_clips(project: Project):
     """
     Renders the provided clips into a single new video file.
     Returns an asset that can be used as a single clip.
@@ -141,7 +227,7 @@ async def merge_clips(project: Project):
         if not has_clips:
             raise HTTPException(status_code=400, detail="No clips to merge")
 
-        result = render_project(project, merge_path, preset='fast', crf=23)
+        result = render_project(project, merge_path, preset='fast', crf=23, stamp=False)
         if not result:
             raise HTTPException(status_code=500, detail="Merge render failed")
         
@@ -158,7 +244,9 @@ async def merge_clips(project: Project):
             "filename": merge_filename,
             "url": f"/uploads/{merge_filename}",
             "type": "video",
-            "duration": duration
+            "duration": duration,
+            "width": 1920,
+            "height": 1080
         }
     except HTTPException:
         raise
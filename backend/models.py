@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
 
@@ -14,6 +14,8 @@ class Clip(BaseModel):
     speed: float = 1.0 # Playback speed multiplier
     z_index: int = 0
     linked_id: Optional[str] = None # ID of the paired audio/video clip
+    width: Optional[int] = None # Source resolution (video only), probed at upload
+    height: Optional[int] = None
 
 class TextOverlay(BaseModel):
     id: str
@@ -42,11 +44,28 @@ class ShapeOverlay(BaseModel):
 class Track(BaseModel):
     id: str
     type: str # "video", "audio", "av" (Audio from Video)
-    clips: List[Clip] = []
+    clips: List[Clip] = Field(default_factory=list)
 
 class Project(BaseModel):
-    id: str = str(uuid.uuid4())
-    tracks: List[Track] = []
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tracks: List[Track] = Field(default_factory=list)
     duration: float = 0.0
-    text_overlays: List[TextOverlay] = []
-    shape_overlays: List[ShapeOverlay] = []
+    text_overlays: List[TextOverlay] = Field(default_factory=list)
+    shape_overlays: List[ShapeOverlay] = Field(default_factory=list)
+
+class UploadResponse(BaseModel):
+    id: str
+    filename: str
+    url: str
+    type: str # "video" or "audio"
+    duration: float
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+class RenderResponse(BaseModel):
+    status: str # "processing", "ready", "empty" or "error"
+    task_id: Optional[str] = None
+    url: Optional[str] = None
+    preview_url: Optional[str] = None # /export?include_preview=true only
+    codec: Optional[str] = None # Encoder the render worker used
+    detail: Optional[str] = None
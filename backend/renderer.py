@@ -4,10 +4,486 @@ import uuid
 import math
 import subprocess
 import json
-from models import Project
+from typing import Optional
+import hashlib
+import functools
+import operator
+import shutil
+import tempfile
+import string
+import time
+import contextlib
+import fcntl
+from fractions import Fraction
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from filtergraph import FilterGraph, filter_spec
+from models import Project, ShapeOverlay, TextOverlay
 
-def has_audio_stream(file_path: str) -> bool:
-    """Check if a media file has an audio stream using ffprobe."""
+# x264 preset -> NVENC preset (p1 = fastest, p7 = slowest/best quality)
+NVENC_PRESETS = {
+    'ultrafast': 'p1',
+    'superfast': 'p1',
+    'veryfast': 'p2',
+    'faster': 'p3',
+    'fast': 'p4',
+    'medium': 'p5',
+    'slow': 'p6',
+    'slower': 'p7',
+    'veryslow': 'p7',
+}
+
+# Uploads are immutable (uuid filenames), so a path's streams never change.
+# Seeded by /upload, filled lazily by processes that did not see the upload (render workers).
+# Maps path -> {'sample_rate': ...} of its first audio stream, or None if it has no audio.
+AUDIO_STREAM_CACHE: dict[str, Optional[dict]] = {}
+# Same for the first video stream: codec, pix_fmt, displayed width/height and rotation, or None if it has no video.
+VIDEO_STREAM_CACHE: dict[str, Optional[dict]] = {}
+
+# What NVDEC decodes into CUDA frames; anything else is decoded on the CPU and uploaded
+NVDEC_8BIT_CODECS = {'h264', 'hevc', 'vp9', 'av1', 'mpeg1video', 'mpeg2video', 'vc1', 'mjpeg'}
+NVDEC_8BIT_PIX_FMTS = {'yuv420p', 'yuvj420p', 'nv12'}
+NVDEC_10BIT_CODECS = {'hevc', 'vp9', 'av1'}
+NVDEC_10BIT_PIX_FMTS = {'yuv420p10le', 'p010le'}
+
+# Normalized clip segments, keyed by content hash
+CLIP_CACHE_DIR = "media/cache"
+# Segments run at the fastest source frame rate (capped), 30 fps when nothing is known
+DEFAULT_FPS = 30
+MAX_FPS = 60
+# Segments that get re-encoded (e.g. under overlays) are stored near-lossless,
+# so the final encode is the only lossy generation
+INTERMEDIATE_CRF = 16
+CLIP_CACHE_MAX_BYTES = int(float(os.getenv("CLIP_CACHE_GB", "10")) * 1024 ** 3)
+# Segments used this recently may be listed by a render in another worker that has not opened them yet
+CLIP_CACHE_GRACE_SECONDS = 3600
+os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+
+# Fingerprints of the renders that produced each output, kept out of the served media dirs
+RENDER_STAMP_DIR = "media/renders"
+os.makedirs(RENDER_STAMP_DIR, exist_ok=True)
+# Per-output render locks, removed again when the render finishes
+RENDER_LOCK_DIR = "media/locks"
+os.makedirs(RENDER_LOCK_DIR, exist_ok=True)
+
+def detect_nvenc() -> bool:
+    """
+    Check if h264_nvenc can actually encode here.
+    Many ffmpeg builds list the encoder even without an NVIDIA GPU/driver,
+    so encode a single test frame instead of parsing -encoders.
+    """
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+             '-f', 'lavfi', '-i', 'nullsrc=s=256x256',
+             '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            capture_output=True,
+            timeout=30
+        )
+        return result.returncode == 0
+    except Exception:
+        return False
+
+def detect_cuda_pipeline() -> bool:
+    """
+    Check if ffmpeg can decode and scale on the GPU (cuda hwaccel + CUDA filters).
+    Listing -hwaccels/-filters says nothing about the device, so run the real pipeline:
+    upload + scale_cuda + NVENC into a test file, then NVDEC-decode it back through scale_cuda.
+    """
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_path = os.path.join(tmp_dir, 'cuda_probe.mp4')
+            probes = [
+                ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                 '-f', 'lavfi', '-i', 'testsrc=s=256x256:d=0.2',
+                 '-vf', 'format=nv12,hwupload_cuda,scale_cuda=128:128:format=nv12',
+                 '-c:v', 'h264_nvenc', test_path],
+                # scale_cuda rejects software frames, so this fails if NVDEC silently fell back
+                ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                 '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-i', test_path,
+                 '-vf', 'scale_cuda=64:64:format=nv12',
+                 '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            ]
+            for args in probes:
+                result = subprocess.run(args, capture_output=True, timeout=30)
+                if result.returncode != 0:
+                    return False
+        return True
+    except Exception:
+        return False
+
+# Detected once at import, every render reuses it
+NVENC_AVAILABLE = detect_nvenc()
+VIDEO_CODEC = 'h264_nvenc' if NVENC_AVAILABLE else 'libx264'
+
+# Full GPU pipeline (NVDEC -> scale_cuda -> NVENC); set HWACCEL=0 to force CPU decode/filters
+HWACCEL = (
+    os.getenv('HWACCEL', '1').lower() not in ('0', 'false', 'no', 'off')
+    and NVENC_AVAILABLE
+    and detect_cuda_pipeline()
+)
+HWACCEL_INPUT_ARGS = {'hwaccel': 'cuda', 'hwaccel_output_format': 'cuda'} if HWACCEL else {}
+
+def video_encoder_args(preset: str, crf: int) -> dict:
+    """
+    Returns the ffmpeg output kwargs for the video encoder.
+    Uses NVENC when a GPU is available, otherwise libx264 with preset/crf.
+    """
+    if not NVENC_AVAILABLE:
+        args = {'vcodec': 'libx264', 'preset': preset, 'crf': crf}
+        # Preview renders: no lookahead/B-frame buffering (zerolatency also enables sliced threads)
+        if preset == 'ultrafast':
+            args['tune'] = 'zerolatency'
+        return args
+
+    args = {
+        'vcodec': 'h264_nvenc',
+        'preset': NVENC_PRESETS.get(preset, 'p5'),
+        'rc': 'vbr',
+        'cq': crf,
+        'b:v': 0, # Let cq drive quality instead of a bitrate target
+    }
+    # Preview renders favour latency over compression
+    if preset == 'ultrafast':
+        args['tune'] = 'll'
+    return args
+
+@functools.lru_cache(maxsize=None)
+def find_font(font_family: str):
+    """Resolves a font family to a font file through fontconfig (same lookup drawtext uses)."""
+    try:
+        result = subprocess.run(
+            ['fc-match', '-f', '%{file}', font_family],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0 or not result.stdout:
+            return None
+        return result.stdout
+    except Exception:
+        return None
+
+def pil_color(color: str) -> tuple:
+    """
+    Converts an ffmpeg color ('white@0.5', '0xRRGGBB[AA]', '#RRGGBB', 'RRGGBB', names) to RGBA for PIL.
+    Projects kept the ffmpeg syntax from the drawtext days; unknown colors fall back to white.
+    """
+    name, _, alpha = color.strip().partition('@')
+    if name[:2].lower() == '0x':
+        name = '#' + name[2:]
+    elif len(name) in (6, 8) and all(c in string.hexdigits for c in name):
+        name = '#' + name
+    try:
+        rgba = ImageColor.getcolor(name, 'RGBA')
+    except ValueError:
+        print(f"Warning: Unknown color {color!r}, using white")
+        rgba = (255, 255, 255, 255)
+    if alpha:
+        try:
+            # ffmpeg alpha is 0.0-1.0 or 0x00-0xff
+            a = int(alpha, 16) if alpha[:2].lower() == '0x' else round(float(alpha) * 255)
+            rgba = (*rgba[:3], min(max(a, 0), 255))
+        except ValueError:
+            print(f"Warning: Invalid alpha in color {color!r}, ignoring it")
+    return rgba
+
+def draw_text(draw, text_overlay: TextOverlay):
+    """Draws a text overlay (with a black border) onto a 1920x1080 RGBA image."""
+    font_size = text_overlay.font_size
+    font_family = text_overlay.font_family
+    color = pil_color(text_overlay.color)
+    
+    # Get x and y percentages (from left and bottom)
+    x_pct = text_overlay.x
+    y_pct = text_overlay.y
+    
+    font_path = find_font(font_family)
+    font = ImageFont.truetype(font_path, font_size) if font_path else ImageFont.load_default(size=font_size)
+    
+    left, top, right, bottom = draw.textbbox((0, 0), text_overlay.text, font=font, stroke_width=2)
+    text_w = right - left
+    text_h = bottom - top
+    
+    # x: percentage from left
+    # y: percentage from bottom (image y=0 is top, so we need to invert)
+    x = (1920 - text_w) * x_pct / 100
+    y = 1080 - text_h - (1080 - text_h) * y_pct / 100
+    
+    draw.text(
+        (x - left, y - top),
+        text_overlay.text,
+        font=font,
+        fill=color,
+        stroke_width=2,
+        stroke_fill='black'
+    )
+
+def render_overlay_track(project: Project, overlay_dir: str):
+    """
+    Composites all text and shape overlays into one timed image sequence.
+    The timeline is split at every overlay start/end; each interval gets a single
+    pre-rendered frame holding everything active in it. Returns the concat list path
+    and an enable expression covering the intervals that have content, or None.
+    """
+    # Text first, shapes on top, matching the old filter order.
+    # Overlays that end at or before t=0 are never visible, dropping them keeps the enable expression non-empty
+    overlays = [
+        o for o in [*project.text_overlays, *project.shape_overlays]
+        if o.end_time > max(o.start_time, 0.0)
+    ]
+    if not overlays:
+        return None
+    
+    boundaries = sorted({max(0.0, t) for o in overlays for t in (o.start_time, o.end_time)})
+    
+    blank_path = os.path.join(overlay_dir, 'blank.png')
+    Image.new('RGBA', (1920, 1080), (0, 0, 0, 0)).save(blank_path)
+    
+    entries = []
+    if boundaries[0] > 0:
+        entries.append((blank_path, boundaries[0]))
+    
+    active_ranges = []
+    frames = {}
+    for t0, t1 in zip(boundaries, boundaries[1:]):
+        active = tuple(o for o in overlays if o.start_time <= t0 and o.end_time >= t1)
+        if not active:
+            entries.append((blank_path, t1 - t0))
+            continue
+        
+        key = tuple(id(o) for o in active)
+        if key not in frames:
+            image = Image.new('RGBA', (1920, 1080), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(image)
+            for o in active:
+                if isinstance(o, TextOverlay):
+                    draw_text(draw, o)
+                else:
+                    draw_shape(draw, o)
+            frames[key] = os.path.join(overlay_dir, f'frame_{len(frames)}.png')
+            image.save(frames[key])
+        
+        entries.append((frames[key], t1 - t0))
+        active_ranges.append(f'between(t,{t0},{t1})')
+    
+    list_path = os.path.join(overlay_dir, 'overlays.txt')
+    with open(list_path, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for path, duration in entries:
+            f.write(f"file '{path}'\nduration {duration}\n")
+        # The concat demuxer ignores the last entry's duration, close with a blank frame
+        f.write(f"file '{blank_path}'\n")
+    
+    return list_path, '+'.join(active_ranges)
+
+def draw_shape(draw, shape: ShapeOverlay):
+    """Draws a line/arrow shape onto a 1920x1080 RGBA image."""
+    shape_type = shape.type
+    color = pil_color(shape.color)
+    width = shape.width
+    
+    # Get coordinates as percentages
+    x1_pct = shape.x1
+    y1_pct = shape.y1
+    x2_pct = shape.x2
+    y2_pct = shape.y2
+    
+    # Calculate actual pixel values for 1920x1080
+    # y is inverted: 0% from bottom = bottom of screen, 100% from bottom = top
+    x1_px = int(1920 * x1_pct / 100)
+    y1_px = int(1080 - 1080 * y1_pct / 100)
+    x2_px = int(1920 * x2_pct / 100)
+    y2_px = int(1080 - 1080 * y2_pct / 100)
+    
+    # Draw the main line
+    draw.line([(x1_px, y1_px), (x2_px, y2_px)], fill=color, width=width)
+    
+    # If it's an arrow, draw the arrowhead
+    if shape_type == 'arrow':
+        # Calculate angle of the line
+        angle = math.atan2(y2_px - y1_px, x2_px - x1_px)
+        
+        # Arrowhead size based on line width
+        arrow_size = width * 5
+        
+        # Calculate arrowhead points (two lines forming a V at the end)
+        angle1 = angle + math.pi * 0.8  # 144 degrees from line direction
+        angle2 = angle - math.pi * 0.8
+        
+        ax1 = int(x2_px + arrow_size * math.cos(angle1))
+        ay1 = int(y2_px + arrow_size * math.sin(angle1))
+        ax2 = int(x2_px + arrow_size * math.cos(angle2))
+        ay2 = int(y2_px + arrow_size * math.sin(angle2))
+        
+        draw.line([(ax1, ay1), (x2_px, y2_px), (ax2, ay2)], fill=color, width=width, joint='curve')
+
+def video_input(path: str, gpu_decode: bool = HWACCEL):
+    """Video input, decoded straight into GPU memory when gpu_decode is set."""
+    return ffmpeg.input(path, **(HWACCEL_INPUT_ARGS if gpu_decode else {}))
+
+def segment_cache_path(key: tuple, fps: str, preset: str, crf: int) -> str:
+    """Cache path for a segment described by key, encoded with the given settings."""
+    full_key = (*key, fps, VIDEO_CODEC, preset, crf)
+    return os.path.join(CLIP_CACHE_DIR, f"{hashlib.sha1(repr(full_key).encode()).hexdigest()}.ts")
+
+def evict_clip_cache():
+    """
+    Deletes least recently used segments until the cache fits in CLIP_CACHE_MAX_BYTES.
+    Every render touches the segments it lists, and segments touched within
+    CLIP_CACHE_GRACE_SECONDS are never deleted, so concurrent renders keep their inputs.
+    """
+    grace_cutoff = time.time() - CLIP_CACHE_GRACE_SECONDS
+    entries = []
+    for name in os.listdir(CLIP_CACHE_DIR):
+        path = os.path.join(CLIP_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= CLIP_CACHE_MAX_BYTES or mtime >= grace_cutoff:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def render_segment(segment_path: str, v, fps: str, preset: str, crf: int) -> str:
+    """
+    Encodes v into an MPEG-TS segment at segment_path.
+    All segments share size, frame rate, pixel format and encoder settings,
+    so the concat demuxer can join them without re-encoding.
+    """
+    v = v.filter('fps', fps)
+    if not HWACCEL:
+        v = v.filter('format', 'yuv420p')
+    
+    # Render to a temp name so concurrent renders never pick up a partial segment
+    tmp_path = os.path.join(CLIP_CACHE_DIR, f"{uuid.uuid4()}.tmp.ts")
+    try:
+        (
+            ffmpeg
+            .output(v, tmp_path, f='mpegts', **video_encoder_args(preset, crf))
+            .run(overwrite_output=True, quiet=True)
+        )
+        os.replace(tmp_path, segment_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    return segment_path
+
+def cached_clip_segment(clip, fps: str, preset: str, crf: int) -> str:
+    """
+    Returns the path of the clip trimmed, retimed and scaled to 1920x1080.
+    Renders and caches the segment on first use; later renders only concat it.
+    """
+    duration = clip.end_time - clip.start_time
+    # The server-side probe decides whether to resize; the client's width/height
+    # can be stale (e.g. coded size of a rotated source) and is only a fallback
+    info = video_stream_info(clip.source_path)
+    size = (info['width'], info['height']) if info else (clip.width, clip.height)
+    needs_scale = size != (1920, 1080)
+    segment_path = segment_cache_path(
+        ('clip', clip.source_path, clip.source_start, duration, clip.speed, needs_scale), fps, preset, crf
+    )
+    if os.path.exists(segment_path):
+        os.utime(segment_path) # Mark as recently used
+        return segment_path
+    
+    # Video: Trim & SetPTS & Scale & SAR
+    speed = clip.speed
+    source_duration = duration * speed
+    
+    # NVDEC silently falls back to software frames for codecs it lacks (VP8, ProRes, MPEG-4 Part 2...),
+    # which scale_cuda rejects, so those are decoded on the CPU and uploaded instead
+    gpu_decode = HWACCEL and nvdec_supported(info)
+    
+    # Reset PTS to 0 for concat: setpts=(PTS-STARTPTS)/speed
+    v = (
+        video_input(clip.source_path, gpu_decode)
+        .video
+        .filter('trim', start=clip.source_start, duration=source_duration)
+        .filter('setpts', f'(PTS-STARTPTS)/{speed}')
+    )
+    if HWACCEL and not gpu_decode:
+        v = v.filter('format', 'nv12').filter('hwupload_cuda')
+    # Sources already at 1920x1080 skip the resize; on the GPU scale_cuda still
+    # normalizes 10-bit/4:4:4 frames to nv12 (render_segment does it on the CPU path)
+    if HWACCEL:
+        if needs_scale:
+            v = v.filter('scale_cuda', 1920, 1080, format='nv12')
+        else:
+            v = v.filter('scale_cuda', format='nv12')
+    elif needs_scale:
+        v = v.filter('scale', 1920, 1080)
+    v = v.filter('setsar', 1, 1)
+    
+    return render_segment(segment_path, v, fps, preset, crf)
+
+def cached_gap_segment(duration: float, fps: str, preset: str, crf: int) -> str:
+    """Returns the path of a black 1920x1080 segment of the given duration."""
+    segment_path = segment_cache_path(('gap', duration), fps, preset, crf)
+    if os.path.exists(segment_path):
+        os.utime(segment_path) # Mark as recently used
+        return segment_path
+    
+    v = ffmpeg.input(f'color=c=black:s=1920x1080:r={fps}:d={duration}', f='lavfi').video
+    if HWACCEL:
+        v = v.filter('format', 'nv12').filter('hwupload_cuda')
+    return render_segment(segment_path, v, fps, preset, crf)
+
+def nvdec_supported(info: Optional[dict]) -> bool:
+    """Whether NVDEC can decode a video stream described by video_info_from_probe()."""
+    # Autorotate inserts CPU-only transpose filters, so rotated sources are decoded in software
+    if info is None or info['rotation'] % 360:
+        return False
+    if info['codec'] in NVDEC_8BIT_CODECS and info['pix_fmt'] in NVDEC_8BIT_PIX_FMTS:
+        return True
+    return info['codec'] in NVDEC_10BIT_CODECS and info['pix_fmt'] in NVDEC_10BIT_PIX_FMTS
+
+def stream_rotation(stream: dict) -> int:
+    """Display rotation of a video stream in degrees (display matrix side data or legacy rotate tag)."""
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(float(side_data['rotation']))
+    return int(float(stream.get('tags', {}).get('rotate', 0)))
+
+def stream_frame_rate(stream: dict) -> Optional[str]:
+    """Average frame rate of a video stream as an exact fraction string ('30000/1001'), None if unknown."""
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            rate = Fraction(stream.get(key, '0/0'))
+        except (ValueError, ZeroDivisionError):
+            continue
+        if rate > 0:
+            return str(rate)
+    return None
+
+def video_info_from_probe(probe: dict) -> Optional[dict]:
+    """Extracts the first video stream's properties from ffprobe output, None if it has none."""
+    stream = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'video'), None)
+    if stream is None:
+        return None
+    rotation = stream_rotation(stream)
+    width, height = stream.get('width'), stream.get('height')
+    # ffmpeg autorotates on decode, so sizes are compared against the displayed frame
+    if rotation % 180:
+        width, height = height, width
+    return {
+        'codec': stream.get('codec_name'),
+        'pix_fmt': stream.get('pix_fmt'),
+        'width': width,
+        'height': height,
+        'rotation': rotation,
+        'frame_rate': stream_frame_rate(stream),
+    }
+
+def probe_streams(file_path: str) -> Optional[dict]:
+    """Runs ffprobe -show_streams on a media file, None if the probe failed."""
     try:
         result = subprocess.run(
             ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', file_path],
@@ -15,119 +491,242 @@ def has_audio_stream(file_path: str) -> bool:
             text=True
         )
         if result.returncode != 0:
-            return False
-        data = json.loads(result.stdout)
-        streams = data.get('streams', [])
-        return any(s.get('codec_type') == 'audio' for s in streams)
+            return None
+        return json.loads(result.stdout)
     except Exception:
+        return None
+
+def video_stream_info(file_path: str) -> Optional[dict]:
+    """Video stream properties of a media file; only successful probes are cached."""
+    if file_path not in VIDEO_STREAM_CACHE:
+        probe = probe_streams(file_path)
+        if probe is None:
+            return None
+        VIDEO_STREAM_CACHE[file_path] = video_info_from_probe(probe)
+    return VIDEO_STREAM_CACHE[file_path]
+
+def audio_info_from_probe(probe: dict) -> Optional[dict]:
+    """Extracts the first audio stream's properties from ffprobe output, None if it has none."""
+    stream = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'audio'), None)
+    if stream is None:
+        return None
+    return {'sample_rate': int(stream.get('sample_rate', 0))}
+
+def audio_stream_info(file_path: str) -> Optional[dict]:
+    """Audio stream properties of a media file; only successful probes are cached."""
+    if file_path not in AUDIO_STREAM_CACHE:
+        # A failed probe (transient I/O error, file still being written) is retried next time,
+        # a file that really has no audio is cached as None
+        probe = probe_streams(file_path)
+        if probe is None:
+            return None
+        AUDIO_STREAM_CACHE[file_path] = audio_info_from_probe(probe)
+    return AUDIO_STREAM_CACHE[file_path]
+
+def has_audio_stream(file_path: str) -> bool:
+    """Check if a media file has an audio stream."""
+    return audio_stream_info(file_path) is not None
+
+def project_frame_rate(clips) -> str:
+    """Frame rate shared by all segments: the fastest source, so 50/60 fps footage is not decimated."""
+    rates = []
+    for clip in clips:
+        info = video_stream_info(clip.source_path)
+        if info and info['frame_rate']:
+            rates.append(Fraction(info['frame_rate']))
+    if not rates:
+        return str(DEFAULT_FPS)
+    return str(min(max(rates), MAX_FPS))
+
+def render_fingerprint(project: Project, preset: str, crf: int) -> str:
+    """
+    Hash of everything that determines one rendered file (sources are immutable uploads).
+    Per output, so a preview rendered alongside an export still matches a later preview-only render.
+    """
+    key = (project.model_dump_json(), preset, crf, VIDEO_CODEC, HWACCEL, MAX_FPS, INTERMEDIATE_CRF)
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+def render_stamp_path(output_path: str) -> str:
+    """File holding the fingerprint of the render that produced output_path."""
+    name = hashlib.sha1(os.path.abspath(output_path).encode()).hexdigest()
+    return os.path.join(RENDER_STAMP_DIR, f"{name}.render")
+
+def is_render_current(output_path: str, fingerprint: str) -> bool:
+    """Check if output_path was produced by a render with this exact fingerprint."""
+    try:
+        with open(render_stamp_path(output_path)) as f:
+            return f.read() == fingerprint and os.path.exists(output_path)
+    except OSError:
         return False
 
-def render_project(project: Project, output_path: str, preset: str = 'ultrafast', crf: int = 28):
+def mix_tree(graph: FilterGraph, streams: list[str]) -> str:
+    """
+    Mixes audio streams through a balanced tree of 2-input amix filters.
+    Each stage works on small buffers, and normalize=0 skips amix's 1/N attenuation.
+    """
+    if len(streams) == 1:
+        return streams[0]
+    mid = len(streams) // 2
+    return graph.chain(
+        [mix_tree(graph, streams[:mid]), mix_tree(graph, streams[mid:])],
+        [filter_spec('amix', inputs=2, duration='longest', normalize=0)]
+    )
+
+def render_project(project: Project, output_path: str, preset: str = 'ultrafast', crf: int = 28, stamp: bool = True):
     """
     Renders the project to the output_path using ffmpeg-python.
     Handles gaps in video track by inserting black frames.
     Normalizes streams to prevent concat errors.
     """
+    result = render_project_outputs(project, [(output_path, preset, crf)], stamp)
+    return result[0] if result else None
+
+def lock_output(output_path: str, stack: contextlib.ExitStack):
+    """
+    Takes the exclusive lock for output_path; it is released and its file removed when stack closes.
+    A waiter may end up holding the lock on a file its previous owner just removed,
+    so the lock only counts once the locked file is still the one at lock_path.
+    """
+    name = hashlib.sha1(os.path.abspath(output_path).encode()).hexdigest()
+    lock_path = os.path.join(RENDER_LOCK_DIR, f"{name}.lock")
+    while True:
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    stack.enter_context(lock_file)
+    # Runs before the file is closed, i.e. while the lock is still held
+    stack.callback(os.remove, lock_path)
+
+@contextlib.contextmanager
+def output_locks(output_paths: list[str]):
+    """
+    Holds an exclusive lock on every output path (sorted, so renders never deadlock).
+    Workers rendering the same project's preview/export then take turns instead of
+    writing the same file at once; the later one usually finds its render current.
+    """
+    with contextlib.ExitStack() as stack:
+        for output_path in sorted(set(output_paths)):
+            lock_output(output_path, stack)
+        yield
+
+def render_project_outputs(project: Project, outputs: list[tuple[str, str, int]], stamp: bool = True):
+    """
+    Renders the project to several (output_path, preset, crf) targets in one ffmpeg run.
+    Decoding and the whole filter graph run once; only the encoders are duplicated.
+    With stamp, outputs already rendered from this exact state are skipped; one-off
+    outputs (merges to a fresh path) pass stamp=False since they are never re-rendered.
+    Returns the list of output paths, or None if there is nothing to render.
+    """
+    with output_locks([output_path for output_path, _, _ in outputs]):
+        return render_outputs(project, outputs, stamp)
+
+def render_outputs(project: Project, outputs: list[tuple[str, str, int]], stamp: bool):
+    """render_project_outputs() body, called with the output locks held."""
+    output_paths = [output_path for output_path, _, _ in outputs]
+    
+    # Identical re-renders (debounced auto-preview, undo back to the last state) skip ffmpeg entirely
+    targets = outputs
+    fingerprints = {}
+    if stamp:
+        fingerprints = {path: render_fingerprint(project, p, c) for path, p, c in outputs}
+        targets = [o for o in outputs if not is_render_current(o[0], fingerprints[o[0]])]
+        if not targets:
+            return output_paths
+    
+    # Cached segments are encoded at the best quality requested
+    _, preset, crf = min(targets, key=lambda o: o[2])
+    # Segments can be stream-copied unless overlays have to be drawn on top;
+    # otherwise keep them near-lossless so the output is not a second generation
+    copy_video = not (project.text_overlays or project.shape_overlays)
+    if not copy_video:
+        crf = min(crf, INTERMEDIATE_CRF)
     
     # 1. Identify Tracks
     video_track = next((t for t in project.tracks if t.type == "video"), None)
+    fps = project_frame_rate(video_track.clips) if video_track else str(DEFAULT_FPS)
     
     # Audio tracks: Includes "audio" AND "av" (linked audio) tracks
     audio_tracks = [t for t in project.tracks if t.type in ["audio", "av"]]
     
+    # The main graph is built as a labelled -filter_complex: every clip gets its own
+    # input and chain, so identical clips need no per-frame uniqueness filters
+    graph = FilterGraph()
+    
     # 2. Process Video Track (Video Only)
     # Note: We now ignore audio from the video track clips because they are moved to 'av' track
-    video_concat_parts = []
+    # Every clip and gap becomes a cached segment file, joined by the concat demuxer
+    video_segments = []
     
-    # Track duration logic
-    max_duration = 0.0
+    # Track duration logic: one pass over every rendered clip
+    rendered_tracks = [video_track, *audio_tracks] if video_track else audio_tracks
+    max_duration = max((c.end_time for t in rendered_tracks for c in t.clips), default=0.0)
     
     if video_track and video_track.clips:
-        sorted_clips = sorted(video_track.clips, key=lambda c: c.start_time)
+        sorted_clips = sorted(video_track.clips, key=operator.attrgetter('start_time'))
         current_time = 0.0
         
         for clip in sorted_clips:
-            max_duration = max(max_duration, clip.end_time)
-            
             # Handle Gap
             if clip.start_time > current_time:
                 gap_duration = clip.start_time - current_time
                 if gap_duration > 0.01: # Threshold
                     # Insert Black Video (Force 1920x1080)
-                    v_gap = (
-                        ffmpeg.input(f'color=c=black:s=1920x1080:d={gap_duration}', f='lavfi')
-                        .video
-                        .filter('metadata', mode='add', key='unique_id', value=str(uuid.uuid4()))
-                    )
                     # No audio gap here, audio is handled separately
-                    video_concat_parts.append(v_gap)
+                    video_segments.append(cached_gap_segment(gap_duration, fps, preset, crf))
             
             # Validate source
             if not os.path.exists(clip.source_path):
                 print(f"Warning: Source file not found: {clip.source_path}")
                 continue
                 
-            duration = clip.end_time - clip.start_time
-            
-            # Input
-            inp = ffmpeg.input(clip.source_path)
-            
-            # Video: Trim & SetPTS & Scale & SAR
-            speed = getattr(clip, 'speed', 1.0)
-            source_duration = duration * speed
-            
-            # Reset PTS to 0 for concat: setpts=(PTS-STARTPTS)/speed
-            # Fix: Add unique metadata to prevent ffmpeg-python from merging identical filter chains
-            unique_id = str(uuid.uuid4())
-            v = (
-                inp.video
-                .filter('metadata', mode='add', key='unique_id', value=unique_id)
-                .filter('trim', start=clip.source_start, duration=source_duration)
-                .filter('setpts', f'(PTS-STARTPTS)/{speed}')
-                .filter('scale', 1920, 1080)
-                .filter('setsar', 1, 1)
-            )
+            # Normalized 1920x1080 segment, reused across renders while the clip is unchanged
+            video_segments.append(cached_clip_segment(clip, fps, preset, crf))
             
             # We DO NOT process audio here anymore for the video track.
             # Audio is expected to be in a separate 'av' track clip.
-                
-            video_concat_parts.append(v)
             
             current_time = clip.end_time
 
-            
-    # Calculate Audio Track Durations
-    for track in audio_tracks:
-        for clip in track.clips:
-            max_duration = max(max_duration, clip.end_time)
+    # Overlay frames and concat lists live here until the render finishes
+    overlay_dir = tempfile.mkdtemp(prefix='overlays_')
 
     # 3. Create Main Video Stream
     main_v = None
     
-    if video_concat_parts:
-        try:
-            # Check if video track needs padding at the end
-            current_video_end = current_time
-            if max_duration > current_video_end:
-                gap_duration = max_duration - current_video_end
-                if gap_duration > 0.01:
-                    v_gap = (
-                        ffmpeg.input(f'color=c=black:s=1920x1080:d={gap_duration}', f='lavfi')
-                        .video
-                        .filter('metadata', mode='add', key='unique_id', value=str(uuid.uuid4()))
-                    )
-                    video_concat_parts.append(v_gap)
-
-            concatenated = ffmpeg.concat(*video_concat_parts, v=1, a=0).node
-            main_v = concatenated[0]
-        except Exception as e:
-            print(f"Concat Error: {e}")
-            return None
+    if video_segments:
+        # Check if video track needs padding at the end
+        current_video_end = current_time
+        if max_duration > current_video_end:
+            gap_duration = max_duration - current_video_end
+            if gap_duration > 0.01:
+                video_segments.append(cached_gap_segment(gap_duration, fps, preset, crf))
+
+        concat_list = os.path.join(overlay_dir, 'concat.txt')
+        with open(concat_list, 'w') as f:
+            for segment_path in video_segments:
+                # Fresh mtime keeps the segment inside other workers' eviction grace window
+                os.utime(segment_path)
+                f.write(f"file '{os.path.abspath(segment_path)}'\n")
+        
+        i = graph.input(concat_list, f='concat', safe=0, **HWACCEL_INPUT_ARGS)
+        main_v = f'[{i}:v]'
+
+        # Text/shape overlays run on CPU frames, bring the stream back from the GPU
+        if HWACCEL and not copy_video:
+            main_v = graph.chain([main_v], ['hwdownload', filter_spec('format', 'nv12')])
     else:
         # If no video clips but there are audio clips, create black video for full duration
         if max_duration > 0:
-             main_v = ffmpeg.input(f'color=c=black:s=1920x1080:d={max_duration}', f='lavfi').video
+             i = graph.input(f'color=c=black:s=1920x1080:r={fps}:d={max_duration}', f='lavfi')
+             main_v = f'[{i}:v]'
+             copy_video = False # Raw lavfi frames always need encoding
         else:
+             shutil.rmtree(overlay_dir, ignore_errors=True)
              return None
         
     # 4. Process Audio Tracks (Includes 'av' tracks now)
@@ -144,151 +743,86 @@ def render_project(project: Project, output_path: str, preset: str = 'ultrafast'
                 continue
                 
             duration = clip.end_time - clip.start_time
-            speed = getattr(clip, 'speed', 1.0)
+            speed = clip.speed
             source_duration = duration * speed
             
-            inp = ffmpeg.input(clip.source_path)
+            i = graph.input(clip.source_path)
             
-            # Fix: Add unique metadata to prevent ffmpeg-python from merging identical audio chains
-            unique_id_a = str(uuid.uuid4())
-            a = inp.audio.filter('ametadata', mode='add', key='unique_id', value=unique_id_a)
+            filters = [
+                filter_spec('atrim', start=clip.source_start, duration=source_duration),
+                filter_spec('asetpts', 'PTS-STARTPTS'),
+            ]
             
-            a = a.filter('atrim', start=clip.source_start, duration=source_duration).filter('asetpts', 'PTS-STARTPTS')
-            
-            if speed != 1.0:
-                 a = a.filter('atempo', speed)
+            # Inaudible tempo changes are not worth a time-stretch pass
+            if abs(speed - 1.0) > 1e-3:
+                 filters.append(filter_spec('atempo', speed))
             
             if clip.volume != 1.0:
-                a = a.filter('volume', volume=clip.volume)
+                filters.append(filter_spec('volume', volume=clip.volume))
             
             # Normalize to match main audio if needed, usually amix handles it but 48k is safe
-            a = a.filter('aresample', 48000)
+            if audio_stream_info(clip.source_path)['sample_rate'] != 48000:
+                filters.append(filter_spec('aresample', 48000))
                 
+            # Offsets under 10 ms are below what can be heard against the video
             delay_ms = int(clip.start_time * 1000)
-            if delay_ms > 0:
-                a = a.filter('adelay', delays=f"{delay_ms}|{delay_ms}")
-            
-            audio_overlays.append(a)
-    
-    # 5. Apply Text Overlays
-    if hasattr(project, 'text_overlays') and project.text_overlays:
-        for text_overlay in project.text_overlays:
-            font_size = getattr(text_overlay, 'font_size', 48)
-            font_family = getattr(text_overlay, 'font_family', 'Sans')
-            color = getattr(text_overlay, 'color', 'white')
-            
-            # Get x and y percentages (from left and bottom)
-            x_pct = getattr(text_overlay, 'x', 50.0)
-            y_pct = getattr(text_overlay, 'y', 10.0)
-            
-            # Convert percentages to ffmpeg expressions
-            # x: percentage from left
-            # y: percentage from bottom (ffmpeg y=0 is top, so we need to invert)
-            x_pos = f'(w-text_w)*{x_pct}/100'
-            y_pos = f'h-text_h-(h-text_h)*{y_pct}/100'
-            
-            # Escape special characters in text for ffmpeg
-            escaped_text = text_overlay.text.replace("'", "\\'").replace(":", "\\:")
-            
-            # Apply drawtext filter with enable expression for timing
-            main_v = main_v.filter(
-                'drawtext',
-                text=escaped_text,
-                fontsize=font_size,
-                font=font_family,
-                fontcolor=color,
-                x=x_pos,
-                y=y_pos,
-                enable=f'between(t,{text_overlay.start_time},{text_overlay.end_time})',
-                borderw=2,
-                bordercolor='black'
-            )
-    
-    # 6. Apply Shape Overlays (Lines and Arrows)
-    # Helper function to draw a line using multiple drawbox filters (since drawline may not exist)
-    def draw_line_with_boxes(video_stream, x1, y1, x2, y2, color, thickness, enable_expr, num_segments=20):
-        """Draw a line using multiple small boxes along the path"""
-        for i in range(num_segments + 1):
-            t = i / num_segments
-            x = int(x1 + t * (x2 - x1))
-            y = int(y1 + t * (y2 - y1))
-            half_t = thickness // 2
-            video_stream = video_stream.filter(
-                'drawbox',
-                x=max(0, x - half_t),
-                y=max(0, y - half_t),
-                w=thickness,
-                h=thickness,
-                color=color,
-                t='fill',
-                enable=enable_expr
-            )
-        return video_stream
-    
-    if hasattr(project, 'shape_overlays') and project.shape_overlays:
-        for shape in project.shape_overlays:
-            shape_type = getattr(shape, 'type', 'line')
-            color = getattr(shape, 'color', 'white')
-            width = getattr(shape, 'width', 3)
-            
-            # Get coordinates as percentages
-            x1_pct = getattr(shape, 'x1', 10.0)
-            y1_pct = getattr(shape, 'y1', 10.0)
-            x2_pct = getattr(shape, 'x2', 90.0)
-            y2_pct = getattr(shape, 'y2', 10.0)
-            
-            # Calculate actual pixel values for 1920x1080
-            # y is inverted: 0% from bottom = bottom of screen, 100% from bottom = top
-            x1_px = int(1920 * x1_pct / 100)
-            y1_px = int(1080 - 1080 * y1_pct / 100)
-            x2_px = int(1920 * x2_pct / 100)
-            y2_px = int(1080 - 1080 * y2_pct / 100)
-            
-            enable_expr = f'between(t,{shape.start_time},{shape.end_time})'
-            
-            # Calculate line length to determine number of segments
-            line_length = math.sqrt((x2_px - x1_px)**2 + (y2_px - y1_px)**2)
-            num_segments = max(10, int(line_length / (width * 0.8)))  # More segments for smoother lines
-            
-            # Draw the main line
-            main_v = draw_line_with_boxes(main_v, x1_px, y1_px, x2_px, y2_px, color, width, enable_expr, num_segments)
-            
-            # If it's an arrow, draw the arrowhead
-            if shape_type == 'arrow':
-                # Calculate angle of the line
-                dx = x2_px - x1_px
-                dy = y2_px - y1_px
-                angle = math.atan2(dy, dx)
-                
-                # Arrowhead size based on line width
-                arrow_size = width * 5
-                
-                # Calculate arrowhead points (two lines forming a V at the end)
-                angle1 = angle + math.pi * 0.8  # 144 degrees from line direction
-                angle2 = angle - math.pi * 0.8
-                
-                ax1 = int(x2_px + arrow_size * math.cos(angle1))
-                ay1 = int(y2_px + arrow_size * math.sin(angle1))
-                ax2 = int(x2_px + arrow_size * math.cos(angle2))
-                ay2 = int(y2_px + arrow_size * math.sin(angle2))
-                
-                # Draw arrowhead lines (fewer segments since they're shorter)
-                main_v = draw_line_with_boxes(main_v, x2_px, y2_px, ax1, ay1, color, width, enable_expr, 8)
-                main_v = draw_line_with_boxes(main_v, x2_px, y2_px, ax2, ay2, color, width, enable_expr, 8)
+            if delay_ms >= 10:
+                filters.append(filter_spec('adelay', delays=f"{delay_ms}|{delay_ms}"))
             
+            audio_overlays.append(graph.chain([f'[{i}:a]'], filters))
+    
+    # 5. Apply Text and Shape Overlays
+    # All overlays are pre-rendered with PIL into one image sequence and blended in a single
+    # overlay pass, gated to the intervals where something is visible
+    overlay_track = render_overlay_track(project, overlay_dir)
+    if overlay_track:
+        list_path, enable_expr = overlay_track
+        i = graph.input(list_path, f='concat', safe=0)
+        overlay_in = graph.chain([f'[{i}:v]'], [filter_spec('format', 'rgba')])
+        main_v = graph.chain(
+            [main_v, overlay_in],
+            [filter_spec('overlay', x=0, y=0, eof_action='pass', enable=enable_expr)]
+        )
+    
     # 7. Mix Audio
-    final_audio = None
-    if len(audio_overlays) > 1:
-        final_audio = ffmpeg.filter(audio_overlays, 'amix', inputs=len(audio_overlays), duration='longest')
-    elif len(audio_overlays) == 1:
-        final_audio = audio_overlays[0]
+    final_audio = mix_tree(graph, audio_overlays) if audio_overlays else None
         
-    # 7. Output
-    streams = [main_v]
-    if final_audio:
-        streams.append(final_audio)
-        
-    out = ffmpeg.output(*streams, output_path, preset=preset, crf=crf)
-    out.run(overwrite_output=True)
+    # 8. Output
+    # A filter output can only feed one encoder, split it when rendering several targets
+    # (an unfiltered input stream can be mapped by any number of outputs)
+    v_outs = [main_v] * len(targets)
+    a_outs = [final_audio] * len(targets)
+    if len(targets) > 1:
+        if not copy_video:
+            v_outs = graph.chain([main_v], [filter_spec('split', len(targets))], outputs=len(targets))
+        if final_audio:
+            a_outs = graph.chain([final_audio], [filter_spec('asplit', len(targets))], outputs=len(targets))
+    
+    for i, (output_path, output_preset, output_crf) in enumerate(targets):
+        streams = [v_outs[i]]
+        if final_audio:
+            streams.append(a_outs[i])
+        # Segments were encoded with exactly these settings: copy instead of re-encoding
+        if copy_video and (output_preset, output_crf) == (preset, crf):
+            video_args = {'c:v': 'copy'}
+        else:
+            video_args = video_encoder_args(output_preset, output_crf)
+        graph.output(streams, output_path, **video_args)
+    
+    # Outputs are about to be overwritten, forget what they held
+    for output_path, _, _ in targets:
+        if os.path.exists(render_stamp_path(output_path)):
+            os.remove(render_stamp_path(output_path))
+    
+    try:
+        graph.run()
+    finally:
+        shutil.rmtree(overlay_dir, ignore_errors=True)
+        # Evict only after the render so its own segments are never dropped mid-use
+        evict_clip_cache()
+    
+    for output_path in fingerprints:
+        with open(render_stamp_path(output_path), 'w') as f:
+            f.write(fingerprints[output_path])
     
-    return output_path
+    return output_paths
@@ -0,0 +1,33 @@
+from celery import Celery
+import os
+from models import Project
+from renderer import render_project_outputs, VIDEO_CODEC
+
+# Broker/result backend; renders run in a separate worker pool, not in the API process
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+celery_app = Celery("renderer", broker=REDIS_URL, backend=REDIS_URL)
+
+# One render per NVENC engine (typically 1-3 per GPU), start with:
+#   uv run celery -A tasks worker --loglevel=info
+celery_app.conf.worker_concurrency = int(os.getenv("RENDER_CONCURRENCY", "1"))
+celery_app.conf.worker_prefetch_multiplier = 1
+celery_app.conf.task_acks_late = True
+# Redis redelivers unacked tasks after visibility_timeout (1 h by default), which would
+# start a second copy of any long export; keep it above the longest render
+celery_app.conf.broker_transport_options = {
+    'visibility_timeout': int(os.getenv("RENDER_VISIBILITY_TIMEOUT", str(12 * 3600)))
+}
+
+@celery_app.task
+def render_task(project_dict: dict, outputs: list):
+    """
+    Renders a serialized Project to every [output_path, preset, crf] target in one ffmpeg run.
+    Returns {"outputs": output paths or None, "codec": encoder this worker used}.
+    """
+    project = Project.model_validate(project_dict)
+    # The API process may run without a GPU, so report what the worker detected
+    return {
+        "outputs": render_project_outputs(project, [tuple(o) for o in outputs]),
+        "codec": VIDEO_CODEC,
+    }
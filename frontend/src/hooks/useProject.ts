@@ -3,7 +3,10 @@ import { Project, Clip, UploadResponse, TextOverlay, ShapeOverlay } from '@/type
 import axios from 'axios';
 import { v4 as uuidv4 } from 'uuid';
 
-const API_URL = 'http://localhost:8000';
+// Point at nginx (not uvicorn) when the backend runs with PROD=1, see backend/README.md
+const API_URL = process.env.NEXT_PUBLIC_API_URL ?? 'http://localhost:8000';
+const PREVIEW_POLL_MS = 500;
+const PREVIEW_MAX_POLLS = 240; // Give up on a render after ~2 minutes
 
 export function useProject() {
   const [project, setProject] = useState<Project>({
@@ -80,6 +83,8 @@ export function useProject() {
                 type: 'video',
                 volume: 0, 
                 speed: 1.0,
+                width: asset.width,
+                height: asset.height,
                 linked_id: audioClipId
             };
 
@@ -171,6 +176,8 @@ export function useProject() {
                 type: 'video',
                 volume: 0,
                 speed: 1.0,
+                width: asset.width,
+                height: asset.height,
                 linked_id: avTrackIndex !== -1 ? audioClipId : undefined
             };
             
@@ -527,7 +534,9 @@ export function useProject() {
                   source_start: 0,
                   type: track.type === 'video' ? 'video' : 'audio',
                   volume: 1.0,
-                  speed: 1.0
+                  speed: 1.0,
+                  width: newAsset.width,
+                  height: newAsset.height
               };
 
               const newTracks = prev.tracks.map(t => {
@@ -603,22 +612,37 @@ export function useProject() {
     const hasClips = project.tracks.some(t => t.clips.length > 0);
     if (!hasClips) return;
 
+    // Aborted when the project changes again, so a stale render never touches state
+    const controller = new AbortController();
+
     debounceRef.current = setTimeout(async () => {
         setIsRendering(true);
         try {
-            const res = await axios.post(`${API_URL}/preview`, project);
+            let res = await axios.post(`${API_URL}/preview`, project, { signal: controller.signal });
+            // Renders run on a worker pool, poll until the task settles
+            for (let attempt = 0; res.data.status === 'processing'; attempt++) {
+                if (attempt >= PREVIEW_MAX_POLLS) {
+                    console.error("Preview render timed out");
+                    break;
+                }
+                await new Promise(resolve => setTimeout(resolve, PREVIEW_POLL_MS));
+                if (controller.signal.aborted) return;
+                res = await axios.get(`${API_URL}/preview/${res.data.task_id}`, { signal: controller.signal });
+            }
             if (res.data.status === 'ready') {
                 setPreviewUrl(`${API_URL}${res.data.url}`);
             }
         } catch (e) {
-            console.error("Preview render failed", e);
+            if (!axios.isCancel(e)) console.error("Preview render failed", e);
         } finally {
-            setIsRendering(false);
+            if (!controller.signal.aborted) setIsRendering(false);
         }
     }, 1000); 
 
     return () => {
         if (debounceRef.current) clearTimeout(debounceRef.current);
+        controller.abort();
+        setIsRendering(false);
     };
   }, [project]);
 
@@ -10,6 +10,8 @@ export interface Clip {
   speed?: number; // Added speed
   z_index?: number;
   linked_id?: string; // ID of paired audio/video clip
+  width?: number; // Source resolution (video only), lets the renderer skip scaling
+  height?: number;
 }
 
 export interface TextOverlay {
@@ -58,4 +60,6 @@ export interface UploadResponse {
     url: string;
     type: 'video' | 'audio';
     duration: number;
+    width?: number;
+    height?: number;
 }